@@ -4,14 +4,24 @@ Azure Speech TTS 批处理脚本（长文分段版，HD 兼容 + 429 限速稳
 
 - 输入：posts/*.txt（第1行=标题；第2行可选 "Date:"；第3行起为正文）
 - 支持行首 "Host:" / "Scientist:" 切换声线
-- 文本清理、按句分块、逐块合成 MP3；可用 ffmpeg / pydub 合并
-- --only-full-to-docs：只把 *_full.mp3 复制到 docs/audio
+- 文本清理、按句分块、逐块合成 MP3；合并优先直接拼接 MP3 帧，其次 ffmpeg / pydub
+- --only-full-to-docs：只把 *_full.mp3 放到 docs/audio（同盘硬链接，否则复制）
 - ✅ HD 名称（含 ":DragonHD"）自动关闭 <prosody>/<break>，避免 InvalidSsml
-- ✅ 429 TooManyRequests：指数退避 + 抖动 + 全局节流（环境变量可调）
+- ✅ 429 TooManyRequests：指数退避（decorrelated jitter，尊重 Retry-After）+ 全局令牌桶限速（TTS_RPS / TTS_BURST；429 时速率减半）
 - ✅ 单段也会产 *_full.mp3；失败/无产物退出码=1；打印取消详情便于排错
+- ✅ 分段并发合成（--concurrency，线程池；按原序号收集结果；跨篇共享在途请求上限与合成器连接池）
+- ✅ 分段内容哈希缓存（默认 tts_out/.cache，--cache-dir / TTS_CACHE_DIR 可改，--no-cache 关闭）：重跑时未变的块直接硬链接，不再请求 Azure
+- ✅ 订阅密钥换授权令牌（issueToken）全进程复用，到期前 / 401 时刷新；换取失败退回密钥认证
+- ✅ 多篇 post 并发处理（--file-concurrency）；合并在全部合成结束后单独进行
+- ✅ 增量：*_full.mp3 比 post 新时跳过该篇（--force 强制重做）
+- ✅ --batch-api：每篇未命中缓存的分段作为一个 Batch Synthesis 任务提交，轮询完成后下载结果 zip；
+  加 --server-concat 由服务端直接拼成整篇（concatenateResult），省去分段文件与本地合并
+- ✅ --bitrate 32/48/64/96/160/192（kbps，默认 96；--use-48k 等同 192）
 """
 
-import os, re, html, datetime, pathlib, sys, glob, unicodedata, argparse, subprocess, time, shutil, random
+import os, re, html, functools, hashlib, datetime, pathlib, sys, glob, unicodedata, argparse, subprocess, time, shutil, random, threading, tempfile, json, uuid, zipfile, queue, contextlib, fnmatch
+import urllib.request, urllib.error
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Tuple
 
 try:
@@ -24,19 +34,77 @@ except Exception as e:
 DEFAULT_INPUT_GLOB = "posts/*.txt"
 DEFAULT_OUT_DIR    = "tts_out"
 DEFAULT_MAX_SENTS  = 100
-DEFAULT_MAX_CHARS  = 3500
+DEFAULT_MAX_CHARS  = 3500   # 实时合成单次音频上限 10 分钟，3500 字符约 4~5 分钟
+BATCH_MAX_SENTS    = 5000   # Batch Synthesis 无 10 分钟限制，块大小只受 SSML 字节上限约束
+BATCH_MAX_CHARS    = 50000
 DEFAULT_BREAK_MS   = 250
-
-DEFAULT_OUTPUT_FORMAT = speechsdk.SpeechSynthesisOutputFormat.Audio24Khz160KBitRateMonoMp3
+DEFAULT_MAX_SSML   = 60000  # Azure 单次 SSML 上限 64KB（按 UTF-8 字节计），预留余量
+DEFAULT_CONCURRENCY = 4
+DEFAULT_FILE_CONCURRENCY = 2
+DEFAULT_RETRY_BASE = 3.0   # 429 退避基数（秒）
+DEFAULT_RETRY_CAP  = 60.0  # 429 退避上限（秒）
+TOKEN_TTL_SECS     = 540   # 授权令牌有效 10 分钟，提前 1 分钟刷新
+DEFAULT_TTS_RPS    = 5.0   # 全局请求速率（个/秒）
+DEFAULT_TTS_BURST  = 10.0  # 令牌桶容量
+
+# --bitrate（kbps）→ SDK 输出格式枚举名；口播 96kbps 单声道已足够，体积约为 160kbps 的 60%
+BITRATE_FORMATS = {
+    32:  "Audio16Khz32KBitRateMonoMp3",
+    48:  "Audio24Khz48KBitRateMonoMp3",
+    64:  "Audio16Khz64KBitRateMonoMp3",
+    96:  "Audio24Khz96KBitRateMonoMp3",
+    160: "Audio24Khz160KBitRateMonoMp3",
+    192: "Audio48Khz192KBitRateMonoMp3",
+}
+DEFAULT_BITRATE = 96
+
+BATCH_API_VERSION  = "2024-04-01"
+BATCH_POLL_START   = 1.0     # Batch Synthesis 轮询：首次间隔（秒），之后 ×1.5
+BATCH_POLL_CAP     = 30.0    # 轮询间隔上限（秒）
+BATCH_TIMEOUT_SECS = 3600.0  # 单个批任务最长等待
+# SDK 输出格式枚举名 → Batch Synthesis REST 的 outputFormat 字符串
+BATCH_OUTPUT_FORMATS = {
+    "Audio16Khz32KBitRateMonoMp3":  "audio-16khz-32kbitrate-mono-mp3",
+    "Audio24Khz48KBitRateMonoMp3":  "audio-24khz-48kbitrate-mono-mp3",
+    "Audio16Khz64KBitRateMonoMp3":  "audio-16khz-64kbitrate-mono-mp3",
+    "Audio24Khz96KBitRateMonoMp3":  "audio-24khz-96kbitrate-mono-mp3",
+    "Audio24Khz160KBitRateMonoMp3": "audio-24khz-160kbitrate-mono-mp3",
+    "Audio48Khz192KBitRateMonoMp3": "audio-48khz-192kbitrate-mono-mp3",
+}
 
 VOICE_HOST_DEFAULT = "en-US-Emma:DragonHDLatestNeural"
 VOICE_SCI_DEFAULT  = "en-US-Andrew:DragonHDLatestNeural"
 RATE_DEFAULT       = "+20%"  # '20%' 会自动转 '+20%'
 
 ROLE_LINE_PAT = re.compile(r'^(host|scientist)\s*:\s*(.+)$', re.I)
-SENT_SPLIT = re.compile(r'(?<=[\.\?\!。！？])\s+')
+DATE_LINE_PAT = re.compile(r'\s*date\s*:(.*)', re.I)
+RATE_PAT      = re.compile(r'[+-]?\d+%')
+SLUG_PAT      = re.compile(r'[^a-z0-9_]+')   # 非法字符与 "-" 的连续串一并折成单个 "-"
+RETRY_AFTER_PAT = re.compile(r'retry[- ]after\D{0,5}(\d+(?:\.\d+)?)', re.I)
+GLOB_MAGIC = re.compile(r'[*?\[]')
+LINE_PAT   = re.compile(r'[^\n]+')
+# 一句 = 非空白开头，到“句末标点 + 空白”之前（或到最后一个非空白字符）；findall 一遍即得去空白的句子
+SENT_FIND = re.compile(r'\S(?:.*?(?<=[\.\?\!。！？])(?=\s)|.*\S|)', re.S)
+# sanitize_text 的单遍翻译表：删零宽字符 + 除 \t \n 以外的 C0 控制字符；单独的 \r 视作换行
+_SANITIZE_TABLE = {i: None for i in range(0x20) if chr(i) not in "\t\n"}
+_SANITIZE_TABLE.update({ord(z): None for z in ("\u200b", "\u200c", "\u200d", "\ufeff", "\u2060")})
+_SANITIZE_TABLE[ord("\r")] = "\n"
+# 其余 str.splitlines 认作换行的字符同样视作换行（正文整块读入，不再经 splitlines）
+_SANITIZE_TABLE.update({ord(c): "\n" for c in "\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"})
+
+SSML_HEAD = '<speak version="1.0" xml:lang="en-US">'
+SSML_TAIL = "</speak>"
 
 # ------------------------ 工具函数 ------------------------
+_LOG_LOCK = threading.Lock()
+
+def log(*parts) -> None:
+    """线程安全日志：整行拼好后一次 write，多线程输出不会互相穿插。"""
+    line = " ".join(map(str, parts)) + "\n"
+    with _LOG_LOCK:
+        sys.stdout.write(line)
+
+@functools.lru_cache(maxsize=256)
 def canonicalize_voice(v: str | None, fallback: str) -> str:
     """保留冒号（HD 声线），仅 strip。"""
     if not v:
@@ -48,23 +116,36 @@ def canonicalize_rate(r: str | None) -> str:
     if not r:
         return RATE_DEFAULT
     r = r.strip()
-    if re.fullmatch(r'[+-]?\d+%', r):
+    if RATE_PAT.fullmatch(r):
         return r if r.startswith(("+", "-")) else ("+" + r)
     return r
 
 def sanitize_text(s: str) -> str:
-    s = s.replace("\r\n", "\n").replace("\r", "\n")
-    for z in ("\u200b", "\u200c", "\u200d", "\ufeff", "\u2060"):
-        s = s.replace(z, "")
-    s = "".join(ch for ch in s if (ch >= " " or ch in "\n\t"))
+    s = s.replace("\r\n", "\n").translate(_SANITIZE_TABLE)
     return unicodedata.normalize("NFC", s)
 
+@functools.lru_cache(maxsize=256)
 def slugify(s: str) -> str:
-    s = s.strip().lower().replace(" ", "-")
-    s = re.sub(r"[^a-z0-9_-]+", "-", s)
-    s = re.sub(r"-{2,}", "-", s)
+    s = SLUG_PAT.sub("-", s.strip().lower())
     return (s[:80].strip("-")) or "episode"
 
+def list_input_files(input_glob: str) -> List[str]:
+    """目录部分不含通配符时，一次 os.scandir + fnmatch 过滤文件名；其它模式仍交给 glob。
+    结果与 glob 一致（模式不以 "." 开头时跳过隐藏文件；只收普通文件）并排序。"""
+    dirname, pattern = os.path.split(input_glob)
+    if GLOB_MAGIC.search(pattern) and not GLOB_MAGIC.search(dirname):
+        hidden_ok = pattern.startswith(".")
+        try:
+            with os.scandir(dirname or ".") as it:
+                files = [os.path.join(dirname, e.name) for e in it
+                         if (hidden_ok or not e.name.startswith(".")) and fnmatch.fnmatch(e.name, pattern)
+                         and e.is_file()]
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+        files.sort()
+        return files
+    return sorted(glob.glob(input_glob))
+
 def parse_role_line(line: str, voice_host: str, voice_sci: str) -> Tuple[str, str]:
     m = ROLE_LINE_PAT.match(line)
     if m:
@@ -75,238 +156,858 @@ def parse_role_line(line: str, voice_host: str, voice_sci: str) -> Tuple[str, st
     return voice_host, line.strip()
 
 def to_sentences(text: str):
-    return [seg.strip() for seg in SENT_SPLIT.split(text) if seg and seg.strip()]
+    return SENT_FIND.findall(text)
 
 def build_dialog_items(body: str, voice_host: str, voice_sci: str):
-    items = []
-    for raw_ln in body.split("\n"):
-        ln = raw_ln.strip()
+    """逐行产出 (voice, 句子列表)。生成器：按 LINE_PAT 在原串上找行，不先建整篇的行列表，
+    chunk_dialog_items 边取边分块。"""
+    for m in LINE_PAT.finditer(body):
+        ln = m.group().strip()
         if not ln:
             continue
         voice, content = parse_role_line(ln, voice_host, voice_sci)
-        sents = to_sentences(content) or [content]
-        items.append((voice, sents))
-    return items
+        yield voice, (to_sentences(content) or [content])
 
-def chunk_dialog_items(items, max_sents: int, max_chars: int):
+def utf8_len(s: str) -> int:
+    """Azure 的 SSML 上限按字节算；中文等非 ASCII 字符一个占 2~4 字节。"""
+    return len(s.encode("utf-8"))
+
+def chunk_dialog_items(items, max_sents: int, max_chars: int, max_ssml: int = DEFAULT_MAX_SSML,
+                       rate: str = RATE_DEFAULT, break_ms: int = DEFAULT_BREAK_MS):
+    """按句数 / 字数 / SSML 字节数三个上限分块。
+    SSML 的 UTF-8 字节数随句子增量累计（与 build_ssml_from_chunk 的模板逐字对应），产出的块无需构建后再测长度。"""
     chunks, cur = [], []
     sent_count = char_count = 0
+    ssml_len = utf8_len(SSML_HEAD) + utf8_len(SSML_TAIL)
+    esc = html.escape
     def flush():
-        nonlocal cur, sent_count, char_count
+        nonlocal cur, sent_count, char_count, ssml_len
         if cur:
             chunks.append(cur); cur = []
             sent_count = 0; char_count = 0
+            ssml_len = utf8_len(SSML_HEAD) + utf8_len(SSML_TAIL)
     for voice, sents in items:
+        run_cost, sent_cost = _ssml_overhead(voice, rate, break_ms)
+        # run：当前块里同一声线的句子列表（可变 [voice, list]），续写时直接 append
+        run = cur[-1][1] if cur and cur[-1][0] == voice else None
         for s in sents:
             s_len = len(s)
-            if (sent_count + 1 > max_sents) or (char_count + s_len > max_chars):
+            s_cost = utf8_len(esc(s)) + sent_cost
+            delta = s_cost if run is not None else s_cost + run_cost
+            if (sent_count + 1 > max_sents) or (char_count + s_len > max_chars) or (ssml_len + delta > max_ssml):
                 flush()
-            if cur and cur[-1][0] == voice:
-                cur[-1][1].append(s)
+                run = None; delta = s_cost + run_cost
+            if run is None:
+                run = [s]
+                cur.append([voice, run])
             else:
-                cur.append((voice, [s]))
-            sent_count += 1; char_count += s_len
+                run.append(s)
+            sent_count += 1; char_count += s_len; ssml_len += delta
     flush()
     return chunks
 
+def split_sentence_in_half(s: str) -> List[str]:
+    """超长单句从中点附近的空白处切成两半（没有空白就直接按字符切）；切不动返回 [s]。"""
+    if len(s) < 2:
+        return [s]
+    mid = len(s) // 2
+    left, right = s.rfind(" ", 0, mid + 1), s.find(" ", mid)
+    cut = min((i for i in (left, right) if i > 0), key=lambda i: abs(i - mid), default=mid)
+    a, b = s[:cut].rstrip(), s[cut:].lstrip()
+    return [a, b] if a and b else [s[:mid], s[mid:]]
+
+def split_chunk_in_half(chunk):
+    """按句数把块对半切开，保持 voice 段顺序；单句块则把句子本身从词边界切开。"""
+    flat = [(voice, s) for voice, sents in chunk for s in sents]
+    if len(flat) == 1:
+        voice, s = flat[0]
+        parts = split_sentence_in_half(s)
+        return [chunk] if len(parts) < 2 else [[[voice, [x]]] for x in parts]
+    if not flat:
+        return [chunk]
+    mid = len(flat) // 2
+    halves = []
+    for part in (flat[:mid], flat[mid:]):
+        c = []
+        for voice, s in part:
+            if c and c[-1][0] == voice:
+                c[-1][1].append(s)
+            else:
+                c.append([voice, [s]])
+        halves.append(c)
+    return halves
+
 def is_hd_voice(voice_name: str) -> bool:
     return ":DragonHD" in voice_name
 
+@functools.lru_cache(maxsize=64)
+def _voice_tags(voice: str, rate: str, break_ms: int) -> Tuple[str, str, str]:
+    """一个 voice 段的 (开标签, 闭标签, 每句句尾)；整批只有两三种组合，转义/拼接只做一次。
+    HD 声线不带 <prosody>/<break>。"""
+    open_tag = f'<voice name="{html.escape(voice)}">'
+    if is_hd_voice(voice):
+        return open_tag, "</voice>", ""
+    return (open_tag + f'<prosody rate="{html.escape(rate)}">', "</prosody></voice>",
+            f"<break time='{int(break_ms)}ms'/>")
+
 def build_ssml_from_chunk(chunk, rate: str, break_ms: int) -> str:
-    parts = []
+    # 标签取自 _voice_tags 缓存；所有片段进同一个列表，最后 join 一次。
+    # 句子按行切出、不含 "\n"：整段用 "\n" 连起来只转义一次，再把 "\n" 换成句间标签
+    esc = html.escape
+    out = [SSML_HEAD]
+    append = out.append
     for voice, sents in chunk:
-        if is_hd_voice(voice):
-            # HD：禁用 prosody/break
-            inner = "".join("<s>" + html.escape(seg) + "</s>" for seg in sents)
-            parts.append(f'<voice name="{html.escape(voice)}">{inner}</voice>')
-        else:
-            inner = "".join(
-                "<s>" + html.escape(seg) + f"</s><break time='{int(break_ms)}ms'/>"
-                for seg in sents
-            )
-            parts.append(
-                f'<voice name="{html.escape(voice)}"><prosody rate="{html.escape(rate)}">{inner}</prosody></voice>'
-            )
-    return '<speak version="1.0" xml:lang="en-US">' + "".join(parts) + "</speak>"
-
-# ------------------------ 合并函数（ffmpeg & pydub 兜底） ------------------------
-def merge_parts_with_ffmpeg(parts: List[pathlib.Path], merged_path: pathlib.Path) -> bool:
-    """用 ffmpeg concat 合并 MP3；失败返回 False。"""
+        open_tag, close_tag, tail = _voice_tags(voice, rate, break_ms)
+        append(open_tag)
+        append("<s>")
+        append(esc("\n".join(sents)).replace("\n", f"</s>{tail}<s>"))
+        append(f"</s>{tail}")
+        append(close_tag)
+    append(SSML_TAIL)
+    return "".join(out)
+
+@functools.lru_cache(maxsize=64)
+def _ssml_overhead(voice: str, rate: str, break_ms: int) -> Tuple[int, int]:
+    """返回 (每个 voice 段的标签开销, 每句的标签开销)，供分块时累计 SSML 字节数。"""
+    open_tag, close_tag, tail = _voice_tags(voice, rate, break_ms)
+    return utf8_len(open_tag + close_tag), len("<s></s>") + utf8_len(tail)
+
+# ------------------------ 合并函数（帧拼接 → ffmpeg → pydub 兜底） ------------------------
+def merge_parts_raw(parts: List[pathlib.Path], merged_path: pathlib.Path) -> bool:
+    """各段同一输出格式、无 ID3 标签时，MP3 帧可直接首尾相接：零解码、零子进程。
+    任一段带 ID3 头则返回 False，交给 ffmpeg。"""
     if not parts:
         return False
     try:
-        lst = merged_path.with_suffix(".txt")
-        lines = ["file '" + str(p).replace("'", "'\\''") + "'" for p in parts]
-        lst.write_text("\n".join(lines), encoding="utf-8")
-        subprocess.run(
-            ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
-             "-f", "concat", "-safe", "0", "-i", str(lst),
-             "-c:a", "libmp3lame", "-b:a", "160k", str(merged_path)],
-            check=True
-        )
-        lst.unlink(missing_ok=True)
-        print("[OK] merged (ffmpeg) ->", merged_path)
+        for p in parts:
+            with open(p, "rb") as f:
+                if f.read(3) == b"ID3":
+                    return False
+        tmp_path = merged_path.with_name(merged_path.name + ".tmp")
+        with open(tmp_path, "wb") as out:
+            for p in parts:
+                with open(p, "rb") as f:
+                    shutil.copyfileobj(f, out, 1024 * 1024)
+        os.replace(tmp_path, merged_path)
+        log("[OK] merged (raw frames) ->", merged_path)
         return True
     except Exception as e:
-        print("[WARN] ffmpeg merge failed:", e)
+        log("[WARN] raw merge failed:", e)
+        return False
+
+def merge_parts_with_ffmpeg(parts: List[pathlib.Path], merged_path: pathlib.Path,
+                            bitrate: int = DEFAULT_BITRATE) -> bool:
+    """用 ffmpeg concat 合并 MP3：先流复制（各段同一输出格式，无需重编码），
+    失败再用 libmp3lame 按 bitrate（kbps）重编码；都失败返回 False。"""
+    if not parts:
+        return False
+    lst = None
+    try:
+        # 列表文件用唯一临时名（与 merged 同目录），不会撞上上次残留或并行合并的同名文件；
+        # concat 列表里的相对路径按列表文件所在目录解析，这里统一写绝对路径；
+        # 引号按 ffmpeg 的规则转义（'\''），shlex.quote 的 "'" 写法 ffmpeg 不认
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=merged_path.parent,
+                                         prefix=merged_path.stem + ".", suffix=".txt", delete=False) as f:
+            lst = pathlib.Path(f.name)
+            for p in parts:
+                f.write("file '" + str(p.resolve()).replace("'", "'\\''") + "'\n")
+        base_cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+                    "-f", "concat", "-safe", "0", "-i", str(lst)]
+        for label, codec_args in (("copy", ["-c:a", "copy"]),
+                                  ("re-encode", ["-c:a", "libmp3lame", "-b:a", f"{bitrate}k", "-threads", "0"])):
+            try:
+                subprocess.run(base_cmd + codec_args + [str(merged_path)], check=True)
+                log(f"[OK] merged (ffmpeg {label}) ->", merged_path)
+                return True
+            except subprocess.CalledProcessError as e:
+                log(f"[WARN] ffmpeg {label} merge failed:", e)
+        return False
+    except Exception as e:
+        log("[WARN] ffmpeg merge failed:", e)
         return False
+    finally:
+        if lst:
+            lst.unlink(missing_ok=True)
 
-def merge_parts_with_pydub(parts: List[pathlib.Path], merged_path: pathlib.Path) -> bool:
+def merge_parts_with_pydub(parts: List[pathlib.Path], merged_path: pathlib.Path,
+                           bitrate: int = DEFAULT_BITRATE) -> bool:
     """无 ffmpeg 时用 pydub 兜底合并。"""
     try:
         from pydub import AudioSegment
         combined = AudioSegment.empty()
         for p in parts:
             combined += AudioSegment.from_file(p)
-        combined.export(str(merged_path), format="mp3", bitrate="160k")
-        print("[OK] merged (pydub) ->", merged_path)
+        combined.export(str(merged_path), format="mp3", bitrate=f"{bitrate}k")
+        log("[OK] merged (pydub) ->", merged_path)
         return True
     except Exception as e:
-        print("[WARN] pydub merge failed:", e)
+        log("[WARN] pydub merge failed:", e)
         return False
 
-# ------------------------ 合成 ------------------------
-def synth_ssml(ssml: str, out_path: str, prefer_voice_for_config: str, output_format):
-    key = os.getenv("SPEECH_KEY"); region = os.getenv("SPEECH_REGION")
-    if not key or not region:
-        raise SystemExit("Missing SPEECH_KEY / SPEECH_REGION secrets.")
-    speech_config = speechsdk.SpeechConfig(subscription=key, region=region)
-    speech_config.speech_synthesis_voice_name = prefer_voice_for_config
-    speech_config.set_speech_synthesis_output_format(output_format)
+# ------------------------ 限速 ------------------------
+class TokenBucket:
+    """线程安全令牌桶：每秒补 rate 个、最多攒 burst 个，acquire() 阻塞到拿到一个令牌。
+    观测到 429 时 penalize() 把速率减半（每个 cooldown 窗口最多减半一次，多个 worker 同时 429 不会连减），
+    cooldown 秒内无新 429 再恢复原速率。"""
+
+    def __init__(self, rate: float, burst: float, cooldown: float = 30.0):
+        self.base_rate = self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.cooldown = cooldown
+        self.penalty_until = 0.0
+        self.last_halved = float("-inf")
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        if self.rate < self.base_rate and now >= self.penalty_until:
+            self.rate = self.base_rate
+            log(f"[THROTTLE] rate restored to {self.rate:.2f}/s")
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                now = self.last
+                wait = (1.0 - self.tokens) / self.rate
+                if self.rate < self.base_rate:
+                    # 减速期间最多睡到惩罚结束，醒来按恢复后的速率重新计算
+                    wait = min(wait, max(0.0, self.penalty_until - now))
+            time.sleep(wait)
 
-    audio_config = speechsdk.audio.AudioOutputConfig(filename=out_path)
-    synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=audio_config)
+    def penalize(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.penalty_until = now + self.cooldown
+            if now - self.last_halved < self.cooldown:
+                return   # 本窗口已减过速：只顺延惩罚期
+            self.last_halved = now
+            self.rate = max(self.base_rate / 64, self.rate / 2)
+            log(f"[THROTTLE] 429 seen, rate -> {self.rate:.2f}/s for {self.cooldown:.0f}s")
 
+# ------------------------ 合成 ------------------------
+_SPEECH_CONFIGS = {}              # (voice, output_format) -> SpeechConfig，整个进程只建一次
+_SPEECH_CONFIGS_LOCK = threading.Lock()
+_SYNTH_POOLS = {}                 # (voice, output_format) -> queue.Queue[(SpeechSynthesizer, Connection)]，全进程共享
+_SYNTH_POOLS_LOCK = threading.Lock()
+_SYNTH_WARMING = {}               # 同上 key -> 仍在预热中的合成器个数；池空时先等它们，不另建
+
+_AUTH = {"token": None, "expiry": 0.0}   # issueToken 结果；token 为 None 表示使用订阅密钥
+_AUTH_LOCK = threading.Lock()
+
+def get_auth_token(force_refresh: bool = False) -> str | None:
+    """用订阅密钥换取授权令牌并缓存 TOKEN_TTL_SECS；未到期直接复用。
+    首次换取失败返回 None（整批改用订阅密钥）；刷新失败则继续用旧令牌。"""
+    with _AUTH_LOCK:
+        if not force_refresh and time.monotonic() < _AUTH["expiry"]:
+            return _AUTH["token"]
+        key = os.getenv("SPEECH_KEY"); region = os.getenv("SPEECH_REGION")
+        if not key or not region:
+            raise SystemExit("Missing SPEECH_KEY / SPEECH_REGION secrets.")
+        req = urllib.request.Request(
+            f"https://{region}.api.cognitive.microsoft.com/sts/v1.0/issueToken",
+            data=b"", method="POST", headers={"Ocp-Apim-Subscription-Key": key},
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=15) as resp:
+                _AUTH["token"] = resp.read().decode("utf-8").strip()
+            _AUTH["expiry"] = time.monotonic() + TOKEN_TTL_SECS
+        except Exception as e:
+            log("[WARN] issueToken failed:", e)
+            if _AUTH["token"] is None:
+                _AUTH["expiry"] = float("inf")   # 首次就失败：整批用订阅密钥，不再反复换取
+        return _AUTH["token"]
+
+def get_speech_config(prefer_voice_for_config: str, output_format):
+    cache_key = (prefer_voice_for_config, output_format)
+    with _SPEECH_CONFIGS_LOCK:
+        speech_config = _SPEECH_CONFIGS.get(cache_key)
+        if speech_config is None:
+            key = os.getenv("SPEECH_KEY"); region = os.getenv("SPEECH_REGION")
+            if not key or not region:
+                raise SystemExit("Missing SPEECH_KEY / SPEECH_REGION secrets.")
+            token = get_auth_token()
+            if token:
+                speech_config = speechsdk.SpeechConfig(auth_token=token, region=region)
+            else:
+                speech_config = speechsdk.SpeechConfig(subscription=key, region=region)
+            speech_config.speech_synthesis_voice_name = prefer_voice_for_config
+            speech_config.set_speech_synthesis_output_format(output_format)
+            _SPEECH_CONFIGS[cache_key] = speech_config
+        return speech_config
+
+def _new_synthesizer(prefer_voice_for_config: str, output_format):
+    """新建 SpeechSynthesizer 并预连接：握手与本地 SSML 准备重叠，首块不再付建连延迟。
+    audio_config=None → 音频留在内存结果里，由调用方写盘，因此一个合成器可服务多个输出文件。"""
+    speech_config = get_speech_config(prefer_voice_for_config, output_format)
+    synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+    conn = None  # 连接对象需与合成器一起保持引用
+    try:
+        conn = speechsdk.Connection.from_speech_synthesizer(synthesizer)
+        conn.open(True)
+    except Exception as e:
+        log("[WARN] connection pre-open failed:", e)
+    return synthesizer, conn
+
+def _synth_pool(prefer_voice_for_config: str, output_format) -> queue.Queue:
+    with _SYNTH_POOLS_LOCK:
+        return _SYNTH_POOLS.setdefault((prefer_voice_for_config, output_format), queue.Queue())
+
+def warm_up_synthesizers(prefer_voice_for_config: str, output_format, n: int) -> None:
+    """并行新建 n 个合成器并预连接后放进池：TLS / 鉴权握手在读文件、构建 SSML 时完成，
+    首批分段直接用热连接。只开连接、不合成，不产生计费字符。"""
+    cache_key = (prefer_voice_for_config, output_format)
+    pool = _synth_pool(prefer_voice_for_config, output_format)
+    with _SYNTH_POOLS_LOCK:
+        _SYNTH_WARMING[cache_key] = _SYNTH_WARMING.get(cache_key, 0) + n
+
+    def warm_one(_):
+        try:
+            pool.put(_new_synthesizer(prefer_voice_for_config, output_format))
+        except Exception as e:
+            log("[WARN] synthesizer warm-up failed:", e)
+        finally:
+            with _SYNTH_POOLS_LOCK:
+                _SYNTH_WARMING[cache_key] -= 1
+
+    with ThreadPoolExecutor(max_workers=max(1, n)) as ex:
+        list(ex.map(warm_one, range(n)))
+
+@contextlib.contextmanager
+def pooled_synthesizer(prefer_voice_for_config: str, output_format):
+    """从全进程共享的池里借一个 SpeechSynthesizer（池空则新建），用完归还。
+    同一时刻一个合成器只给一个线程用；连接跨块、跨篇保持。调用方须先占 inflight 槽位再借，
+    池大小才等于峰值在途请求数（--concurrency），而不是排队等槽位的线程数。"""
+    pool = _synth_pool(prefer_voice_for_config, output_format)
+    try:
+        entry = pool.get_nowait()
+    except queue.Empty:
+        entry = None
+        if _SYNTH_WARMING.get((prefer_voice_for_config, output_format)):
+            try:
+                entry = pool.get(timeout=15)   # 预热中的连接马上就好，等它比另起握手快
+            except queue.Empty:
+                pass
+        if entry is None:
+            entry = _new_synthesizer(prefer_voice_for_config, output_format)
+    try:
+        yield entry[0]
+    finally:
+        pool.put(entry)
+
+def save_result_audio(result, out_path: str, block_size: int = 64 * 1024) -> None:
+    """经 AudioDataStream 分块取出音频写盘（不整体拷贝 result.audio_data）；
+    先写 .tmp 再 os.replace，失败时不留半截 MP3。"""
+    stream = speechsdk.AudioDataStream(result)
+    tmp_path = out_path + ".tmp"
+    buf = bytes(block_size)
+    with open(tmp_path, "wb") as f:
+        n = stream.read_data(buf)
+        while n:
+            f.write(buf[:n])
+            n = stream.read_data(buf)
+    os.replace(tmp_path, out_path)
+
+def synth_ssml(ssml: str, out_path: str, prefer_voice_for_config: str, output_format,
+               retry_base: float = DEFAULT_RETRY_BASE, retry_cap: float = DEFAULT_RETRY_CAP,
+               inflight: threading.Semaphore | None = None, limiter: TokenBucket | None = None):
+    """合成一块并写盘。limiter：全局令牌桶，每次请求（含重试）前取一个令牌；
+    inflight：全局在途请求信号量，每次尝试先占槽位、再借合成器、再取令牌，退避等待不占槽位也不占合成器。"""
     max_retries = int(os.getenv("RETRIES", "10"))
+    refresh_token = False
+    prev_wait = retry_base
     for attempt in range(1, max_retries + 1):
-        result = synthesizer.speak_ssml_async(ssml).get()
+        # 令牌模式：每次请求前取当前令牌（未到期时只是取缓存），换令牌的网络往返不占槽位
+        token = get_auth_token(force_refresh=refresh_token) if _AUTH["token"] else None
+        refresh_token = False
+        # 先占在途槽位再借合成器：等槽位的线程手里不拿合成器，池大小不超过 --concurrency；
+        # 也先占槽位再取令牌：排队的 worker 不囤令牌，槽位空出时不会一齐发出、冲破 TTS_RPS
+        with inflight if inflight is not None else contextlib.nullcontext():
+            with pooled_synthesizer(prefer_voice_for_config, output_format) as synthesizer:
+                if token:
+                    synthesizer.authorization_token = token
+                if limiter is not None:
+                    limiter.acquire()
+                result = synthesizer.speak_ssml_async(ssml).get()
         if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
+            save_result_audio(result, out_path)
             return
         # 失败分支
-        wait = 0.0
+        wait = None
         if result.reason == speechsdk.ResultReason.Canceled:
             cd = result.cancellation_details
             code = getattr(cd, 'error_code', None)
-            print(f"[WARN] attempt {attempt} canceled. reason={getattr(cd,'reason',None)} error_code={code}")
-            print(f"[WARN] details: {getattr(cd,'error_details','')}")
+            log(f"[WARN] attempt {attempt} canceled. reason={getattr(cd,'reason',None)} error_code={code}")
+            log(f"[WARN] details: {getattr(cd,'error_details','')}")
             if str(code) == "CancellationErrorCode.TooManyRequests":
-                wait = min((2 ** attempt) * 3 + random.uniform(0, 2.0), 60.0)
-                print(f"[THROTTLE] 429 backoff {wait:.1f}s before retry")
-        if wait == 0.0:
+                # decorrelated jitter：min(cap, U(base, 上次*3))，并发 worker 的重试时间相互错开
+                wait = prev_wait = min(retry_cap, random.uniform(retry_base, prev_wait * 3))
+                m = RETRY_AFTER_PAT.search(str(getattr(cd, 'error_details', '') or ''))
+                if m:
+                    wait = max(wait, float(m.group(1)))
+                if limiter is not None:
+                    limiter.penalize()
+                log(f"[THROTTLE] 429 backoff {wait:.1f}s before retry")
+            elif str(code) == "CancellationErrorCode.AuthenticationFailure" and _AUTH["token"]:
+                refresh_token = True
+        if wait is None:
             wait = min(1.5 * attempt, 15.0)
         if attempt < max_retries:
             time.sleep(wait)
     raise RuntimeError(f"TTS failed after {max_retries} retries -> {out_path}")
 
+# ------------------------ Batch Synthesis API ------------------------
+def _batch_call(method: str, url: str, body: dict | None = None,
+                retry_base: float = DEFAULT_RETRY_BASE, retry_cap: float = DEFAULT_RETRY_CAP):
+    """调用 Batch Synthesis REST 接口，返回 (JSON, 响应头)；429 / 5xx 按 Retry-After 或 decorrelated jitter 重试，
+    超时 / 连接重置等网络错误同样退避重试（单次轮询抖一下不该让整篇失败、删掉已付费的任务）。
+    认证复用进程级 issueToken 令牌（Bearer，轮询几百次也只换一次令牌），401 时强制刷新后重试；
+    换不到令牌时退回订阅密钥头。"""
+    data = None
+    if body is not None:
+        data = json.dumps(body).encode("utf-8")
+    max_retries = int(os.getenv("RETRIES", "10"))
+    prev_wait = retry_base
+    refresh_token = False
+    for attempt in range(1, max_retries + 1):
+        token = get_auth_token(force_refresh=refresh_token)
+        refresh_token = False
+        headers = ({"Authorization": "Bearer " + token} if token
+                   else {"Ocp-Apim-Subscription-Key": os.getenv("SPEECH_KEY", "")})
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+        req = urllib.request.Request(url, data=data, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=30) as resp:
+                raw = resp.read()
+            return (json.loads(raw) if raw else {}), resp.headers
+        except urllib.error.HTTPError as e:
+            if e.code == 401 and token and attempt < max_retries:
+                log(f"[WARN] batch {method} HTTP 401, refreshing token")
+                refresh_token = True
+                continue
+            if (e.code != 429 and e.code < 500) or attempt == max_retries:
+                detail = e.read().decode("utf-8", "replace")[:500]
+                raise RuntimeError(f"batch {method} HTTP {e.code}: {detail}") from e
+            wait = prev_wait = min(retry_cap, random.uniform(retry_base, prev_wait * 3))
+            retry_after = e.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                wait = max(wait, float(retry_after))
+            log(f"[THROTTLE] batch {method} HTTP {e.code}, retry in {wait:.1f}s")
+            time.sleep(wait)
+        except (urllib.error.URLError, TimeoutError, ConnectionError) as e:
+            if attempt == max_retries:
+                raise RuntimeError(f"batch {method} failed: {e}") from e
+            wait = prev_wait = min(retry_cap, random.uniform(retry_base, prev_wait * 3))
+            log(f"[WARN] batch {method} network error ({e}), retry in {wait:.1f}s")
+            time.sleep(wait)
+
+def _download_batch_result(result_url: str, out_paths: List[pathlib.Path],
+                           retry_base: float = DEFAULT_RETRY_BASE, retry_cap: float = DEFAULT_RETRY_CAP) -> None:
+    """下载结果 zip（SAS 地址，不带认证头），按序号 0001.mp3… 依次解到各 out_path（.tmp + os.replace）。
+    网络错误 / 5xx / 429 按 decorrelated jitter 重新下载；其它 4xx（如 SAS 失效）直接失败。"""
+    max_retries = int(os.getenv("RETRIES", "10"))
+    prev_wait = retry_base
+    with tempfile.TemporaryFile() as tmp:
+        for attempt in range(1, max_retries + 1):
+            tmp.seek(0); tmp.truncate()
+            try:
+                with urllib.request.urlopen(result_url, timeout=300) as resp:
+                    shutil.copyfileobj(resp, tmp, 64 * 1024)
+                break
+            except (urllib.error.URLError, TimeoutError, ConnectionError) as e:
+                permanent = isinstance(e, urllib.error.HTTPError) and e.code < 500 and e.code != 429
+                if permanent or attempt == max_retries:
+                    raise RuntimeError(f"batch result download failed: {e}") from e
+                wait = prev_wait = min(retry_cap, random.uniform(retry_base, prev_wait * 3))
+                log(f"[WARN] batch result download failed ({e}), retry in {wait:.1f}s")
+                time.sleep(wait)
+        tmp.seek(0)
+        with zipfile.ZipFile(tmp) as zf:
+            names = sorted(n for n in zf.namelist() if n.lower().endswith(".mp3"))
+            if len(names) != len(out_paths):
+                raise RuntimeError(f"batch result has {len(names)} mp3, expected {len(out_paths)}")
+            for name, out_path in zip(names, out_paths):
+                tmp_path = out_path.with_name(out_path.name + ".tmp")
+                with zf.open(name) as src, open(tmp_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, 64 * 1024)
+                os.replace(tmp_path, out_path)
+
+def batch_synthesize(ssmls: List[str], out_paths: List[pathlib.Path], output_format, concatenate: bool = False,
+                     poll_start: float = BATCH_POLL_START, poll_cap: float = BATCH_POLL_CAP,
+                     timeout_secs: float = BATCH_TIMEOUT_SECS) -> None:
+    """一篇的全部分段作为一个 Batch Synthesis 任务提交，由服务端并行合成；
+    轮询到 Succeeded 后下载结果写到各 out_path，最后删除任务。失败 / 超时抛 RuntimeError。
+    concatenate=True：服务端把各段拼成一个 MP3（concatenateResult），out_paths 只给一个路径。"""
+    key = os.getenv("SPEECH_KEY"); region = os.getenv("SPEECH_REGION")
+    if not key or not region:
+        raise SystemExit("Missing SPEECH_KEY / SPEECH_REGION secrets.")
+    fmt = BATCH_OUTPUT_FORMATS.get(output_format.name)
+    if fmt is None:
+        raise SystemExit(f"Output format {output_format.name} not supported by --batch-api.")
+    job_id = uuid.uuid4().hex
+    url = (f"https://{region}.api.cognitive.microsoft.com/texttospeech/batchsyntheses/{job_id}"
+           f"?api-version={BATCH_API_VERSION}")
+    _, headers = _batch_call("PUT", url, {
+        "inputKind": "SSML",
+        "inputs": [{"content": ssml} for ssml in ssmls],
+        "properties": {"outputFormat": fmt, "concatenateResult": concatenate},
+    })
+    # 轮询服务端给的 operation-location（只含 status）；间隔从 poll_start 起 ×1.5 增长到 poll_cap，加 30% 抖动：
+    # 短任务很快拿到结果，长任务也不会频繁请求。到终态后再 GET 任务本身取 outputs / error
+    status_url = headers.get("Operation-Location") or url
+    try:
+        deadline = time.monotonic() + timeout_secs
+        delay = poll_start
+        while True:
+            status = _batch_call("GET", status_url)[0].get("status")
+            if status in ("Succeeded", "Failed"):
+                break
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"batch synthesis {job_id} timed out (status={status})")
+            time.sleep(delay + random.uniform(0, 0.3 * delay))
+            delay = min(poll_cap, delay * 1.5)
+        job, _ = _batch_call("GET", url)
+        if status == "Failed" or job.get("status") == "Failed":
+            raise RuntimeError(f"batch synthesis {job_id} failed: {job.get('properties', {}).get('error') or job}")
+        _download_batch_result(job["outputs"]["result"], out_paths)
+    finally:
+        try:
+            _batch_call("DELETE", url)
+        except Exception as e:
+            log("[WARN] batch job delete failed:", e)
+
+# ------------------------ 分段缓存 ------------------------
+def chunk_key(ssml: str, voice: str, output_format) -> str:
+    """分段缓存键：SSML（已含声线/语速/停顿）+ 配置声线 + 输出格式。"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(ssml.encode("utf-8")); h.update(b"|")
+    h.update(voice.encode("utf-8")); h.update(b"|")
+    h.update(str(output_format).encode("utf-8"))
+    return h.hexdigest()
+
+def link_or_copy(src, dst) -> None:
+    """src → dst：优先硬链接（同一文件系统零拷贝），失败退回 copy2。
+    经临时名 + os.replace 落地，不会写穿 dst 上已有的硬链接。"""
+    dst = pathlib.Path(dst)
+    if dst.exists() and os.path.samefile(src, dst):
+        return
+    tmp = dst.with_name(dst.name + ".tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+def cache_store(out_path, cache_path) -> None:
+    """合成结果链接进缓存；失败只警告，不影响本次产出。"""
+    try:
+        link_or_copy(out_path, cache_path)
+    except OSError as e:
+        log("[WARN] cache store failed:", e)
+
+# ------------------------ 单篇处理 ------------------------
+def parse_header(first: str, second: str) -> Tuple[str, str]:
+    """post 头两行 → (标题, 日期)；第二行不是 Date: 时用今天。"""
+    title = (first or "Episode").strip()
+    m = DATE_LINE_PAT.match(second)
+    date = m.group(1).strip() if m else datetime.date.today().isoformat()
+    return title, date
+
+def episode_base_name(title: str, date: str) -> str:
+    return slugify(date) + "_" + slugify(title) + ".mp3"
+
+def full_output_path(p: pathlib.Path, out_dir: str) -> pathlib.Path:
+    """只读头两行，算出该 post 合并后的 *_full.mp3 路径（与 process_file/produce_full 命名一致）。"""
+    with open(p, encoding="utf-8") as f:
+        first, second = f.readline().rstrip("\n"), f.readline().rstrip("\n")
+    title, date = parse_header(first, second)
+    return pathlib.Path(out_dir) / (pathlib.Path(episode_base_name(title, date)).stem + "_full.mp3")
+
+def settings_fingerprint(args, output_format) -> str:
+    """影响产出音频的参数指纹（声线、语速、停顿、输出格式、分块上限、合成方式）。"""
+    fields = (args.voice_host, args.voice_sci, args.rate, args.break_ms, output_format.name,
+              args.max_sents, args.max_chars, args.max_ssml,
+              args.batch_api, args.batch_api and args.server_concat)
+    return hashlib.blake2b(repr(fields).encode("utf-8"), digest_size=16).hexdigest()
+
+def stamp_path(full: pathlib.Path) -> pathlib.Path:
+    return full.with_name(full.name + ".stamp")
+
+def is_up_to_date(p: pathlib.Path, full: pathlib.Path, fingerprint: str) -> bool:
+    """full 比 post 新、且旁边 .stamp 记录的参数指纹与本次一致，才视为已是最新。
+    full 可能是缓存文件的硬链接或 copy2 副本，mtime 沿用旧值，所以同时看 ctime（产出/链接时间）。"""
+    try:
+        st = full.stat()
+        stamp = stamp_path(full).read_text(encoding="utf-8").strip()
+    except (FileNotFoundError, UnicodeDecodeError):
+        return False
+    return stamp == fingerprint and max(st.st_mtime, st.st_ctime) >= p.stat().st_mtime
+
+def process_file(p: pathlib.Path, args, output_format, limiter: TokenBucket | None = None,
+                 inflight: threading.Semaphore | None = None) -> List[pathlib.Path]:
+    """解析单个 post → 分块 → 线程池并发合成；返回按块序排列的分段 MP3。
+    文件过短返回空列表；任一块失败则取消剩余任务并抛出异常。"""
+    # 头两行逐行读，正文一次读完：不建行列表、不再 join
+    with open(p, encoding="utf-8") as f:
+        first, second, rest = f.readline(), f.readline(), f.read()
+    if not rest:
+        log("[WARN] too short:", p); return []
+    title, date = parse_header(first.rstrip("\n"), second.rstrip("\n"))
+    body = sanitize_text(rest.strip())
+    if len(body) < 20:
+        log("[WARN] body short:", p); return []
+
+    base_out  = pathlib.Path(args.out_dir) / episode_base_name(title, date)
+
+    items  = build_dialog_items(body, args.voice_host, args.voice_sci)
+    chunks = chunk_dialog_items(items, max_sents=args.max_sents, max_chars=args.max_chars,
+                                max_ssml=args.max_ssml, rate=args.rate, break_ms=args.break_ms)
+
+    # 先把全部 SSML 构建好，再交给线程池（worker 从全局池借用 SpeechSynthesizer）
+    # 超过 --max-ssml（UTF-8 字节）的块用工作栈对半切：只重建被切开的两半，合格的块只构建一次；
+    # 单句超限时按词边界硬切，保证发出去的每个请求都在上限内，不浪费一次 Canceled 往返
+    ssmls = []
+    for chunk in chunks:
+        stack = [chunk]
+        while stack:
+            c = stack.pop()
+            ssml = build_ssml_from_chunk(c, args.rate, args.break_ms)
+            n = utf8_len(ssml)
+            halves = split_chunk_in_half(c) if n > args.max_ssml else [c]
+            if len(halves) > 1:
+                log(f"[WARN] SSML {n} bytes > {args.max_ssml}, splitting chunk")
+                stack.extend(reversed(halves))
+            else:
+                ssmls.append(ssml)
+
+    jobs = []
+    for idx, ssml in enumerate(ssmls, 1):
+        out_path = base_out if len(ssmls) == 1 else base_out.with_name(base_out.stem + "_part" + str(idx) + base_out.suffix)
+        jobs.append((idx, ssml, out_path))
+    # 发请求前先报告全部分段的 SSML 规模，便于对照配额 / 排查超限
+    log("[INFO]", p, "chunks=" + str(len(jobs)),
+          "ssml_total=" + str(sum(utf8_len(j[1]) for j in jobs)),
+          "ssml_max=" + str(max((utf8_len(j[1]) for j in jobs), default=0)))
+
+    cache_dir = None if args.no_cache else pathlib.Path(args.cache_dir or pathlib.Path(args.out_dir) / ".cache")
+    if cache_dir:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+    if args.batch_api and args.server_concat and len(jobs) > 1:
+        # 服务端拼接：整篇一个任务、一个 MP3，不产分段；合并阶段只剩单段硬链接成 *_full.mp3
+        ssmls = [j[1] for j in jobs]
+        cache_path = cache_dir / (chunk_key("\n".join(ssmls), args.voice_host, output_format) + ".mp3") if cache_dir else None
+        if cache_path and cache_path.exists():
+            link_or_copy(cache_path, base_out)
+            log("[CACHE]", p, "->", base_out)
+        else:
+            log("[BATCH]", p, "->", len(ssmls), "chunks, server concat")
+            batch_synthesize(ssmls, [base_out], output_format, concatenate=True)
+            if cache_path:
+                cache_store(base_out, cache_path)
+        return [base_out]
+
+    done, misses = {}, []
+    for idx, ssml, out_path in jobs:
+        cache_path = cache_dir / (chunk_key(ssml, args.voice_host, output_format) + ".mp3") if cache_dir else None
+        if cache_path and cache_path.exists():
+            link_or_copy(cache_path, out_path)
+            log("[CACHE]", p, "->", out_path)
+            done[idx] = out_path
+        else:
+            misses.append((idx, ssml, out_path, cache_path))
+
+    def finish(idx, out_path, cache_path):
+        done[idx] = out_path
+        if cache_path:
+            cache_store(out_path, cache_path)
+
+    if args.batch_api and misses:
+        # Batch Synthesis：未命中缓存的块一次提交，服务端并行合成
+        log("[BATCH]", p, "->", len(misses), "chunks")
+        batch_synthesize([m[1] for m in misses], [m[2] for m in misses], output_format)
+        for idx, _, out_path, cache_path in misses:
+            finish(idx, out_path, cache_path)
+    elif misses:
+        with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as ex:
+            futures = {}
+            for idx, ssml, out_path, cache_path in misses:
+                log("[TTS]", p, "->", out_path)
+                fut = ex.submit(synth_ssml, ssml, str(out_path), args.voice_host, output_format,
+                                retry_cap=args.retry_cap, inflight=inflight, limiter=limiter)
+                futures[fut] = (idx, out_path, cache_path)
+
+            for fut in as_completed(futures):
+                idx, out_path, cache_path = futures[fut]
+                try:
+                    fut.result()
+                except BaseException:
+                    for f in futures:
+                        f.cancel()
+                    raise
+                finish(idx, out_path, cache_path)
+
+    return [done[i] for i in sorted(done)]
+
+def produce_full(outs: List[pathlib.Path], bitrate: int = DEFAULT_BITRATE) -> Tuple[pathlib.Path, bool]:
+    """把一篇的分段合并成 *_full.mp3（单段直接硬链接，跨盘时复制）；返回 (full 路径, 是否完整)。
+    所有合并方式都失败时退回只链接第一段，此时返回 False（full 只是截断的一段）。
+    旧的 full 先 unlink：它可能与 docs/audio 里的文件是硬链接，不能原地覆盖。"""
+    if len(outs) > 1:
+        merged = outs[0].with_name(outs[0].stem.replace("_part1", "") + "_full.mp3")
+        merged.unlink(missing_ok=True)
+        ok = bool(merge_parts_raw(outs, merged) or merge_parts_with_ffmpeg(outs, merged, bitrate)
+                  or merge_parts_with_pydub(outs, merged, bitrate))
+        if not ok:
+            link_or_copy(outs[0], merged)
+            log("[OK] fallback linked first part as full ->", merged)
+        return merged, ok
+    src = outs[0]; merged = src.with_name(src.stem + "_full.mp3")
+    link_or_copy(src, merged)
+    log("[OK] single-part linked as full ->", merged)
+    return merged, True
+
 # ------------------------ main ------------------------
 def main():
     ap = argparse.ArgumentParser(description="Azure Speech TTS batch (long-text segmented).")
     ap.add_argument("--input-glob", default=os.getenv("INPUT_GLOB", DEFAULT_INPUT_GLOB))
     ap.add_argument("--out-dir",    default=os.getenv("OUT_DIR", DEFAULT_OUT_DIR))
-    ap.add_argument("--max-sents",  type=int, default=int(os.getenv("MAX_SENTS", DEFAULT_MAX_SENTS)))
-    ap.add_argument("--max-chars",  type=int, default=int(os.getenv("MAX_CHARS", DEFAULT_MAX_CHARS)))
+    ap.add_argument("--max-sents",  type=int, default=os.getenv("MAX_SENTS"))   # 默认随 --batch-api 而定
+    ap.add_argument("--max-chars",  type=int, default=os.getenv("MAX_CHARS"))
+    ap.add_argument("--max-ssml",   type=int, default=int(os.getenv("MAX_SSML", DEFAULT_MAX_SSML)))
     ap.add_argument("--break-ms",   type=int, default=int(os.getenv("BREAK_MS", DEFAULT_BREAK_MS)))
+    ap.add_argument("--concurrency", type=int, default=int(os.getenv("CONCURRENCY", DEFAULT_CONCURRENCY)))
+    ap.add_argument("--file-concurrency", type=int, default=int(os.getenv("FILE_CONCURRENCY", DEFAULT_FILE_CONCURRENCY)))
+    ap.add_argument("--retry-cap",  type=float, default=float(os.getenv("RETRY_CAP", DEFAULT_RETRY_CAP)))
+    ap.add_argument("--cache-dir",  default=os.getenv("TTS_CACHE_DIR", ""))   # 空 = <out-dir>/.cache
+    ap.add_argument("--no-cache",   action="store_true")
     ap.add_argument("--merge",      action="store_true")
+    ap.add_argument("--batch-api",  action="store_true", help="改用 Batch Synthesis REST API（每篇一个任务），不走 SDK 实时合成")
+    ap.add_argument("--server-concat", action="store_true",
+                    help="配合 --batch-api：由服务端拼接整篇（concatenateResult），不产分段、不做本地合并；缓存按整篇计")
     ap.add_argument("--voice-host", default=canonicalize_voice(os.getenv("VOICE_HOST"), VOICE_HOST_DEFAULT))
     ap.add_argument("--voice-sci",  default=canonicalize_voice(os.getenv("VOICE_SCI"),  VOICE_SCI_DEFAULT))
     ap.add_argument("--rate",       default=os.getenv("SPEED", RATE_DEFAULT))
-    ap.add_argument("--use-48k",    action="store_true")
+    ap.add_argument("--bitrate",    type=int, choices=sorted(BITRATE_FORMATS),
+                    default=os.getenv("BITRATE", DEFAULT_BITRATE), help="MP3 码率（kbps）")
+    ap.add_argument("--use-48k",    action="store_true", help="等同 --bitrate 192（48kHz）")
     ap.add_argument("--only-full-to-docs", action="store_true")
+    ap.add_argument("--force", action="store_true", help="忽略 mtime，已是最新的 post 也重新生成")
     args = ap.parse_args()
+    # argparse 不拿 choices 校验 default（BITRATE 环境变量），这里补上
+    if args.bitrate not in BITRATE_FORMATS:
+        ap.error(f"argument --bitrate: invalid choice: {args.bitrate} (choose from {', '.join(map(str, sorted(BITRATE_FORMATS)))})")
 
     out_dir = pathlib.Path(args.out_dir); out_dir.mkdir(parents=True, exist_ok=True)
     args.rate = canonicalize_rate(args.rate)
-
-    files = sorted(glob.glob(args.input_glob))
+    if args.max_sents is None:
+        args.max_sents = BATCH_MAX_SENTS if args.batch_api else DEFAULT_MAX_SENTS
+    if args.max_chars is None:
+        args.max_chars = BATCH_MAX_CHARS if args.batch_api else DEFAULT_MAX_CHARS
+    if args.server_concat and not args.batch_api:
+        log("[WARN] --server-concat only applies with --batch-api; ignored")
+
+    files = list_input_files(args.input_glob)
     if not files:
-        print("[ERROR] No files matched:", args.input_glob); sys.exit(1)
+        log("[ERROR] No files matched:", args.input_glob); sys.exit(1)
 
-    output_format = (
-        speechsdk.SpeechSynthesisOutputFormat.Audio48Khz192KBitRateMonoMp3
-        if args.use_48k else DEFAULT_OUTPUT_FORMAT
-    )
+    if args.use_48k:
+        args.bitrate = 192
+    output_format = getattr(speechsdk.SpeechSynthesisOutputFormat, BITRATE_FORMATS[args.bitrate])
 
-    # 全局节流参数（可通过环境变量调）
-    throttle_ms = int(os.getenv("THROTTLE_MS", "3000"))          # 每块间隔（毫秒）
-    pause_every = int(os.getenv("CHUNK_PAUSE_EVERY", "5"))       # 每 N 块长休眠
-    pause_secs  = float(os.getenv("CHUNK_PAUSE_SECS", "15"))     # 长休眠秒数
-
-    merged_outputs, failures = [], []
+    # 全局限速：所有篇、所有分段共用一个令牌桶（TTS_RPS<=0 关闭）
+    tts_rps   = float(os.getenv("TTS_RPS", DEFAULT_TTS_RPS))
+    tts_burst = float(os.getenv("TTS_BURST", DEFAULT_TTS_BURST))
+    limiter = TokenBucket(tts_rps, tts_burst) if tts_rps > 0 else None
 
+    # 增量：*_full.mp3 比 post 新且参数指纹一致的直接跳过（仅 --merge 时有 full 可比；--force 关闭）
+    fingerprint = settings_fingerprint(args, output_format)
+    up_to_date, todo = {}, []
     for fp in files:
         p = pathlib.Path(fp)
         try:
-            raw = p.read_text(encoding="utf-8").splitlines()
-            if len(raw) < 3:
-                print("[WARN] too short:", p); continue
-            title = (raw[0] or "Episode").strip()
-            date = raw[1].split(":", 1)[1].strip() if raw[1].lower().startswith("date:") else datetime.date.today().isoformat()
-            body = sanitize_text("\n".join(raw[2:]).strip())
-            if len(body) < 20:
-                print("[WARN] body short:", p); continue
-
-            safe_date = slugify(date)
-            base_name = safe_date + "_" + slugify(title) + ".mp3"
-            base_out  = pathlib.Path(args.out_dir) / base_name
-
-            items  = build_dialog_items(body, args.voice_host, args.voice_sci)
-            chunks = chunk_dialog_items(items, max_sents=args.max_sents, max_chars=args.max_chars)
-            print("[INFO] chunks=" + str(len(chunks)))
-
-            outs = []
-            for idx, chunk in enumerate(chunks, 1):
-                ssml = build_ssml_from_chunk(chunk, args.rate, args.break_ms)
-                out_path = base_out if len(chunks) == 1 else base_out.with_name(base_out.stem + "_part" + str(idx) + base_out.suffix)
-                print("[TTS]", p, "->", out_path)
-                synth_ssml(ssml, str(out_path), args.voice_host, output_format)
-                outs.append(out_path)
-
-                # 全局节流：每块之间等待；每 N 块再长休眠
-                if idx < len(chunks):
-                    if throttle_ms > 0:
-                        time.sleep(throttle_ms / 1000.0)
-                    if pause_every > 0 and (idx % pause_every == 0):
-                        print(f"[THROTTLE] periodic sleep {pause_secs:.1f}s after chunk {idx}")
-                        time.sleep(pause_secs)
-
-            # 合并/产出 full
-            if args.merge and outs:
-                if len(outs) > 1:
-                    merged = outs[0].with_name(outs[0].stem.replace("_part1", "") + "_full.mp3")
-                    ok = merge_parts_with_ffmpeg(outs, merged) or merge_parts_with_pydub(outs, merged)
-                    if not ok:
-                        shutil.copy2(outs[0], merged)
-                        print("[OK] fallback copied first part as full ->", merged)
-                    merged_outputs.append(merged)
-                else:
-                    src = outs[0]; merged = src.with_name(src.stem + "_full.mp3")
-                    shutil.copy2(src, merged)
-                    print("[OK] single-part copied as full ->", merged)
-                    merged_outputs.append(merged)
-
-        except SystemExit as e:
-            print("[FAIL]", p, ":", e); failures.append((str(p), str(e)))
-        except Exception as e:
-            print("[FAIL]", p, ":", e); failures.append((str(p), str(e)))
-
-    # 复制到 docs/audio
+            full = full_output_path(p, args.out_dir) if args.merge and not args.force else None
+        except (OSError, UnicodeDecodeError):
+            full = None  # 读不了头部就照常处理，由 process_file 报错
+        if full is not None and is_up_to_date(p, full, fingerprint):
+            log("[SKIP] up-to-date:", p, "->", full); up_to_date[p] = full
+        else:
+            todo.append(p)
+
+    # 预热：后台建好 --concurrency 个已连接的合成器，与读文件 / 构建 SSML 重叠（Batch 模式不用 SDK）
+    if todo and not args.batch_api:
+        threading.Thread(target=warm_up_synthesizers, daemon=True,
+                         args=(args.voice_host, output_format, max(1, args.concurrency))).start()
+
+    # 全局在途请求上限：多篇并发时总请求数仍不超过 --concurrency
+    inflight = threading.BoundedSemaphore(max(1, args.concurrency))
+    synthesized, failures = [], []
+
+    # 合成阶段：多篇并发（每篇内部再按 --concurrency 并发分段）
+    with ThreadPoolExecutor(max_workers=max(1, args.file_concurrency)) as ex:
+        futs = {ex.submit(process_file, p, args, output_format, limiter, inflight): p
+                for p in todo}
+        for fut in as_completed(futs):
+            p = futs[fut]
+            try:
+                outs = fut.result()
+                if outs:
+                    synthesized.append((p, outs))
+            except SystemExit as e:
+                log("[FAIL]", p, ":", e); failures.append((str(p), str(e)))
+            except Exception as e:
+                log("[FAIL]", p, ":", e); failures.append((str(p), str(e)))
+    synthesized.sort(key=lambda t: t[0])
+
+    # 合并阶段：全部合成完成后再跑 ffmpeg，避免与进行中的合成争 CPU；各篇之间按核数并行
+    merged_by_post = dict(up_to_date)
+    if args.merge and synthesized:
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as ex:
+            futs = [(p, ex.submit(produce_full, outs, args.bitrate)) for p, outs in synthesized]
+            for p, fut in futs:
+                try:
+                    full, merged_ok = fut.result()
+                    merged_by_post[p] = full
+                except Exception as e:
+                    log("[FAIL]", p, ":", e); failures.append((str(p), str(e)))
+                    continue
+                # 只有真正合并成功才写指纹；退回“只链接第一段”时删掉旧指纹，下次运行重试合并
+                try:
+                    if merged_ok:
+                        stamp_path(full).write_text(fingerprint + "\n", encoding="utf-8")
+                    else:
+                        stamp_path(full).unlink(missing_ok=True)
+                except OSError as e:
+                    log("[WARN] stamp update failed (next run will redo this post):", e)
+    merged_outputs = [merged_by_post[p] for p in sorted(merged_by_post)]
+
+    # 发布到 docs/audio（硬链接，跨盘时退回复制）
     if args.only_full_to_docs and merged_outputs:
         docs_dir = pathlib.Path("docs/audio"); docs_dir.mkdir(parents=True, exist_ok=True)
         for f in merged_outputs:
             try:
                 target = docs_dir / f.name
-                shutil.copy2(f, target)
-                print("[OK] copied", f, "->", target)
+                link_or_copy(f, target)
+                log("[OK] linked", f, "->", target)
             except Exception as e:
-                print("[FAIL] copy to docs/audio failed:", e)
+                log("[FAIL] copy to docs/audio failed:", e)
                 failures.append((str(f), f"copy failed: {e}"))
 
     if failures:
-        print("\nSome files failed:")
-        for f, e in failures: print(" -", f, ":", e)
+        log("\nSome files failed:")
+        for f, e in failures: log(" -", f, ":", e)
         sys.exit(1)
     if not merged_outputs:
-        print("[ERROR] No MP3 generated."); sys.exit(1)
+        log("[ERROR] No MP3 generated."); sys.exit(1)
 
 if __name__ == "__main__":
     main()